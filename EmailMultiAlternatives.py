@@ -1,368 +1,274 @@
-import os
+import json
 import logging
+from functools import partial
 from django.contrib import messages
 from django.shortcuts import get_object_or_404, redirect
 from django.views.decorators.http import require_POST
 from django.http import JsonResponse
 from django.utils import timezone
 from django.db import transaction
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
-from django.conf import settings
-import mimetypes
 
-from apps.bluebird.models import Section, Entry, EntryField, DocumentMetadata
+from apps.bluebird.models import Section, Entry, EntryField
 from apps.bluebird.services.infrastructure import _send_file_to_s3
 from apps.bluebird.services import workflow_services as wf
+from apps.bluebird.tasks import (
+    release_queued_emails,
+    send_correspondence_email_task,
+    send_correspondence_emails_task,
+)
 
 logger = logging.getLogger(__name__)
 
 
-def send_correspondence_email(request, module_context, email_id):
+class CompactJsonResponse(JsonResponse):
     """
-    Send an email correspondence and update its status to 'Sent'.
+    JsonResponse that emits compact, non-ASCII-escaped UTF-8 JSON.
     """
-    try:
-        # Get the email correspondence entry
-        email_entry = Entry.objects.get(
-            id=email_id, section__key="purge/internal/email"
+
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault(
+            "json_dumps_params", {"separators": (",", ":"), "ensure_ascii": False}
         )
+        super().__init__(data, **kwargs)
 
-        # Get the email details from entry fields
-        email_fields = {field.key: field.value for field in email_entry.fields.all()}
-
-        # Validate required fields for sending
-        required_fields = ["recipient_email", "subject", "email_date", "email_type"]
-        missing_fields = []
-        for field in required_fields:
-            if not email_fields.get(field):
-                missing_fields.append(field.replace("_", " ").title())
-
-        if missing_fields:
-            error_msg = f"Cannot send email. Missing required fields: {', '.join(missing_fields)}"
-
-            # Return JSON for AJAX requests
-            if request.headers.get("Content-Type") == "application/json":
-                return JsonResponse({"success": False, "error": error_msg})
-
-            # Fallback to original redirect behavior
-            messages.error(request, error_msg)
-            purge_record_id = email_fields.get("purge_record_id")
-            if purge_record_id:
-                return redirect(
-                    "bluebird:view_email_correspondence_for_purge",
-                    purge_record_id=purge_record_id,
-                )
-            return redirect("bluebird:view_internal_purge_records")
-
-        # Check if email is in Draft status
-        current_status = email_fields.get("status", "")
-        if current_status != "Draft":
-            error_msg = f"Email cannot be sent. Current status: {current_status}. Only Draft emails can be sent."
-
-            # Return JSON for AJAX requests
-            if request.headers.get("Content-Type") == "application/json":
-                return JsonResponse({"success": False, "error": error_msg})
-
-            # Fallback to original redirect behavior
-            messages.warning(request, error_msg)
-            purge_record_id = email_fields.get("purge_record_id")
-            if purge_record_id:
-                return redirect(
-                    "bluebird:view_email_correspondence_for_purge",
-                    purge_record_id=purge_record_id,
-                )
-            return redirect("bluebird:view_internal_purge_records")
-
-        # === ACTUAL EMAIL SENDING LOGIC ===
-        try:
-            recipient_email = email_fields.get("recipient_email", "")
-            subject = email_fields.get("subject", "")
-            body_content = email_fields.get("body_content", "")
-            sender_email = email_fields.get("sender_email", settings.DEFAULT_FROM_EMAIL)
-
-            # Get CC and BCC if they exist
-            cc_emails = email_fields.get("cc_emails", "")
-            bcc_emails = email_fields.get("bcc_emails", "")
-
-            # Parse CC and BCC (assume comma-separated)
-            cc_list = [email.strip() for email in cc_emails.split(",") if email.strip()] if cc_emails else []
-            bcc_list = [email.strip() for email in bcc_emails.split(",") if email.strip()] if bcc_emails else []
-
-            # Get purge record information for context
-            purge_record_id = email_fields.get("purge_record_id")
-            purge_info = {}
-            if purge_record_id:
-                try:
-                    purge_record = Entry.objects.get(
-                        id=purge_record_id,
-                        section__key__in=["purge/internal", "purge/ic"]
-                    )
-                    purge_fields = {field.key: field.value for field in purge_record.fields.all()}
-                    purge_info = {
-                        "id": purge_record_id,
-                        "account": purge_fields.get("account", "N/A"),
-                        "provider": purge_fields.get("provider", "N/A"),
-                        "facility": purge_fields.get("facility", "N/A"),
-                        "status": purge_fields.get("status", "N/A"),
-                    }
-                except Entry.DoesNotExist:
-                    pass
-
-            # Prepare email context for template
-            email_context = {
-                "subject": subject,
-                "body_content": body_content,
-                "email_type": email_fields.get("email_type", ""),
-                "priority": email_fields.get("priority", "Normal"),
-                "purge_info": purge_info,
-                "sender_name": request.user.get_full_name() or request.user.username,
-                "email_date": email_fields.get("email_date", timezone.now().strftime("%Y-%m-%d")),
-            }
-
-            # Create HTML email from template (if template exists)
-            try:
-                html_content = render_to_string(
-                    "emails/correspondence_email.html",
-                    email_context
-                )
-                # Create plain text version by stripping HTML
-                text_content = strip_tags(body_content)
-            except Exception as template_error:
-                # Fallback to plain text if template doesn't exist
-                logger.warning(f"Email template not found, using plain text: {template_error}")
-                html_content = f"""
-                <html>
-                    <body>
-                        <div style="font-family: Arial, sans-serif; padding: 20px;">
-                            <h2>{subject}</h2>
-                            <div style="white-space: pre-wrap;">{body_content}</div>
-                            <hr style="margin: 20px 0;">
-                            <p style="color: #666; font-size: 12px;">
-                                This email was sent via the Purge Workflow System<br>
-                                Email Type: {email_fields.get("email_type", "N/A")}<br>
-                                Priority: {email_fields.get("priority", "Normal")}<br>
-                                Sent by: {request.user.get_full_name() or request.user.username}
-                            </p>
-                        </div>
-                    </body>
-                </html>
-                """
-                text_content = body_content
-
-            # Create the email message
-            email_message = EmailMultiAlternatives(
-                subject=subject,
-                body=text_content,
-                from_email=sender_email,
-                to=[recipient_email],
-                cc=cc_list if cc_list else None,
-                bcc=bcc_list if bcc_list else None,
-                reply_to=[sender_email] if sender_email != settings.DEFAULT_FROM_EMAIL else None,
-            )
 
-            # Attach HTML version
-            email_message.attach_alternative(html_content, "text/html")
+def _redirect_back(purge_record_id):
+    """
+    Redirect to the purge record's correspondence, or the purge record list.
+    """
+    if purge_record_id:
+        return redirect(
+            "bluebird:view_email_correspondence_for_purge",
+            purge_record_id=purge_record_id,
+        )
+    return redirect("bluebird:view_internal_purge_records")
 
-            # Attach files from DocumentMetadata
-            attachments = DocumentMetadata.objects.filter(
-                entry=email_entry,
-                is_deleted=False
-            )
 
-            attachment_errors = []
-            for attachment in attachments:
-                try:
-                    # Download file from S3
-                    import boto3
-                    from botocore.exceptions import ClientError
+def _error_response(request, is_json, error_msg, purge_record_id=None, level=messages.ERROR):
+    """
+    Return the error as JSON for AJAX requests, otherwise flash it and redirect
+    back to the purge record's correspondence (or the purge record list).
+    """
+    if is_json:
+        return CompactJsonResponse({"success": False, "error": error_msg})
 
-                    s3_client = boto3.client('s3')
-                    bucket_name = os.environ.get("BLUEBIRD_FILES_BUCKET")
+    messages.add_message(request, level, error_msg)
+    return _redirect_back(purge_record_id)
 
-                    # Get file from S3
-                    s3_response = s3_client.get_object(
-                        Bucket=bucket_name,
-                        Key=attachment.s3_key
-                    )
-                    file_content = s3_response['Body'].read()
-
-                    # Determine MIME type
-                    mime_type, _ = mimetypes.guess_type(attachment.filename)
-                    if not mime_type:
-                        mime_type = 'application/octet-stream'
-
-                    # Attach to email
-                    email_message.attach(
-                        attachment.filename,
-                        file_content,
-                        mime_type
-                    )
 
-                except ClientError as s3_error:
-                    error_detail = f"S3 error for {attachment.filename}: {str(s3_error)}"
-                    logger.error(error_detail)
-                    attachment_errors.append(error_detail)
-                except Exception as attach_error:
-                    error_detail = f"Failed to attach {attachment.filename}: {str(attach_error)}"
-                    logger.error(error_detail)
-                    attachment_errors.append(error_detail)
-
-            # Send the email
-            try:
-                email_message.send(fail_silently=False)
-                email_sent_successfully = True
-                send_error = None
-            except Exception as send_error_obj:
-                email_sent_successfully = False
-                send_error = str(send_error_obj)
-                logger.error(f"Failed to send email: {send_error}")
-
-            # If email sending failed, return error
-            if not email_sent_successfully:
-                error_msg = f"Failed to send email: {send_error}"
-
-                if request.headers.get("Content-Type") == "application/json":
-                    return JsonResponse({"success": False, "error": error_msg})
-
-                messages.error(request, error_msg)
-                purge_record_id = email_fields.get("purge_record_id")
-                if purge_record_id:
-                    return redirect(
-                        "bluebird:view_email_correspondence_for_purge",
-                        purge_record_id=purge_record_id,
-                    )
-                return redirect("bluebird:view_internal_purge_records")
+def _send_validation_error(email_fields):
+    """
+    Return ``(error_msg, level)`` if the email can't be sent, otherwise None.
+    """
+    # Validate required fields for sending
+    required_fields = ["recipient_email", "subject", "email_date", "email_type"]
+    missing_fields = []
+    for field in required_fields:
+        if not email_fields.get(field):
+            missing_fields.append(field.replace("_", " ").title())
 
-        except Exception as email_prep_error:
-            error_msg = f"Error preparing email: {str(email_prep_error)}"
-            logger.error(error_msg)
+    if missing_fields:
+        error_msg = f"Cannot send email. Missing required fields: {', '.join(missing_fields)}"
+        return error_msg, messages.ERROR
 
-            if request.headers.get("Content-Type") == "application/json":
-                return JsonResponse({"success": False, "error": error_msg})
+    # Check if email is in Draft status
+    current_status = email_fields.get("status", "")
+    if current_status != "Draft":
+        error_msg = f"Email cannot be sent. Current status: {current_status}. Only Draft emails can be sent."
+        return error_msg, messages.WARNING
 
-            messages.error(request, error_msg)
-            purge_record_id = email_fields.get("purge_record_id")
-            if purge_record_id:
-                return redirect(
-                    "bluebird:view_email_correspondence_for_purge",
-                    purge_record_id=purge_record_id,
-                )
-            return redirect("bluebird:view_internal_purge_records")
-
-        # === UPDATE DATABASE AFTER SUCCESSFUL SEND ===
-        # Update status and sent_date using bulk operations
-        fields_to_update_bulk = []
-        fields_to_create = []
-        existing_fields = {field.key: field for field in email_entry.fields.all()}
-
-        # Handle status field
-        if "status" in existing_fields:
-            status_field = existing_fields["status"]
-            status_field.value = "Sent"
-            fields_to_update_bulk.append(status_field)
-        else:
-            fields_to_create.append(
-                EntryField(entry=email_entry, key="status", value="Sent")
-            )
+    return None
 
-        # Handle sent_date field
-        sent_date_value = timezone.now().isoformat()
-        if "sent_date" in existing_fields:
-            sent_date_field = existing_fields["sent_date"]
-            sent_date_field.value = sent_date_value
-            fields_to_update_bulk.append(sent_date_field)
-        else:
-            fields_to_create.append(
-                EntryField(entry=email_entry, key="sent_date", value=sent_date_value)
-            )
 
-        # Add sent_by field
-        if "sent_by" in existing_fields:
-            sent_by_field = existing_fields["sent_by"]
-            sent_by_field.value = request.user.username
-            fields_to_update_bulk.append(sent_by_field)
-        else:
-            fields_to_create.append(
-                EntryField(entry=email_entry, key="sent_by", value=request.user.username)
-            )
+def _dispatch_queued(email_ids, task, *args):
+    """
+    Hand queued emails to Celery. If the broker can't take the task, put the
+    emails back into Draft before re-raising so they can be sent again.
+    """
+    try:
+        task.delay(*args)
+    except Exception:
+        release_queued_emails(email_ids)
+        raise
+
+
+def send_correspondence_email(request, module_context, email_id):
+    """
+    Queue an email correspondence for sending and update its status to 'Queued'.
+    """
+    is_json = request.headers.get("Content-Type") == "application/json"
+    try:
+        # Get the email correspondence entry
+        email_entry = Entry.objects.only("id").get(
+            id=email_id, section__key="purge/internal/email"
+        )
 
-        # Perform all database operations atomically
-        with transaction.atomic():
-            # Bulk create new fields
-            if fields_to_create:
-                EntryField.objects.bulk_create(fields_to_create)
+        # Get the email details from entry fields
+        email_fields = dict(email_entry.fields.values_list("key", "value"))
+
+        validation_error = _send_validation_error(email_fields)
+        if validation_error:
+            error_msg, level = validation_error
+            return _error_response(
+                request, is_json, error_msg, email_fields.get("purge_record_id"), level=level
+            )
 
-            # Bulk update existing fields
-            if fields_to_update_bulk:
-                EntryField.objects.bulk_update(fields_to_update_bulk, ["value"])
+        # === QUEUE EMAIL FOR SENDING ===
+        # S3 downloads and SMTP delivery happen in a Celery worker; the request
+        # only flips the status and dispatches the task once it is committed
+        subject = email_fields.get("subject", "")
+        recipient_email = email_fields.get("recipient_email", "")
+        with transaction.atomic(savepoint=False):
+            # Only the request that actually moves the email out of Draft
+            # dispatches it, so concurrent clicks can't queue it twice
+            queued = EntryField.objects.filter(
+                entry=email_entry, key="status", value="Draft"
+            ).update(value="Queued")
+            if not queued:
+                error_msg = "Email cannot be sent. It has already been queued for sending."
+                return _error_response(
+                    request,
+                    is_json,
+                    error_msg,
+                    email_fields.get("purge_record_id"),
+                    level=messages.WARNING,
+                )
 
             # Update entry modified timestamp with specific field update
-            email_entry.modified_at = timezone.now()
-            email_entry.save(update_fields=["modified_at"])
+            Entry.objects.filter(pk=email_entry.pk).update(modified_at=timezone.now())
+
+            transaction.on_commit(
+                partial(
+                    _dispatch_queued,
+                    [email_entry.id],
+                    send_correspondence_email_task,
+                    email_entry.id,
+                    request.user.id,
+                )
+            )
 
         # Success response
-        success_msg = f"Email '{subject}' has been sent successfully to {recipient_email}."
-
-        # Add warning if there were attachment errors
-        if attachment_errors:
-            warning_msg = f"Email sent, but some attachments failed: {'; '.join(attachment_errors[:3])}"
-            if len(attachment_errors) > 3:
-                warning_msg += f" and {len(attachment_errors) - 3} more..."
-            logger.warning(warning_msg)
-
-            if request.headers.get("Content-Type") == "application/json":
-                return JsonResponse(
-                    {
-                        "success": True,
-                        "message": success_msg,
-                        "warning": warning_msg,
-                        "status": "Sent",
-                        "sent_date": timezone.now().isoformat(),
-                    }
-                )
-            messages.success(request, success_msg)
-            messages.warning(request, warning_msg)
-        else:
-            # Return JSON for AJAX requests
-            if request.headers.get("Content-Type") == "application/json":
-                return JsonResponse(
-                    {
-                        "success": True,
-                        "message": success_msg,
-                        "status": "Sent",
-                        "sent_date": timezone.now().isoformat(),
-                    }
-                )
-            messages.success(request, success_msg)
+        success_msg = f"Email '{subject}' has been queued for sending to {recipient_email}."
 
-        # Redirect back to the email correspondence view
-        purge_record_id = email_fields.get("purge_record_id")
-        if purge_record_id:
-            return redirect(
-                "bluebird:view_email_correspondence_for_purge",
-                purge_record_id=purge_record_id,
+        # Return JSON for AJAX requests
+        if is_json:
+            return CompactJsonResponse(
+                {
+                    "success": True,
+                    "message": success_msg,
+                    "status": "Queued",
+                }
             )
+        messages.success(request, success_msg)
+
+        # Redirect back to the email correspondence view
+        return _redirect_back(email_fields.get("purge_record_id"))
 
     except Entry.DoesNotExist:
         error_msg = f"Email correspondence with ID {email_id} not found."
-
-        # Return JSON for AJAX requests
-        if request.headers.get("Content-Type") == "application/json":
-            return JsonResponse({"success": False, "error": error_msg})
-
-        # Fallback to original redirect behavior
-        messages.error(request, error_msg)
+        return _error_response(request, is_json, error_msg)
     except Exception as e:
         error_msg = f"Error sending email: {str(e)}"
         logger.error(f"Unexpected error in send_correspondence_email: {str(e)}", exc_info=True)
+        return _error_response(request, is_json, error_msg)
+
+
+@require_POST
+def send_correspondence_emails(request, module_context):
+    """
+    Queue several Draft email correspondences to be sent together over one
+    mail connection and update their status to 'Queued'.
+    """
+    is_json = request.headers.get("Content-Type") == "application/json"
+    purge_record_id = None
+    try:
+        if is_json:
+            payload = json.loads(request.body or b"{}")
+            email_ids = [str(email_id) for email_id in payload.get("email_ids", [])]
+            purge_record_id = payload.get("purge_record_id")
+        else:
+            email_ids = request.POST.getlist("email_ids")
+            purge_record_id = request.POST.get("purge_record_id")
+
+        if not email_ids:
+            return _error_response(request, is_json, "No emails selected to send.", purge_record_id)
+
+        # Get the email details for every selected entry in one query
+        entry_ids = set(
+            str(entry_id)
+            for entry_id in Entry.objects.filter(
+                id__in=email_ids, section__key="purge/internal/email"
+            ).values_list("id", flat=True)
+        )
+        fields_by_entry = {entry_id: {} for entry_id in entry_ids}
+        for entry_id, key, value in EntryField.objects.filter(
+            entry_id__in=entry_ids
+        ).values_list("entry_id", "key", "value"):
+            fields_by_entry[str(entry_id)][key] = value
+
+        queued_ids = []
+        errors = []
+        with transaction.atomic(savepoint=False):
+            for email_id in email_ids:
+                if email_id not in entry_ids:
+                    errors.append(f"Email correspondence with ID {email_id} not found.")
+                    continue
+
+                validation_error = _send_validation_error(fields_by_entry[email_id])
+                if validation_error:
+                    errors.append(f"Email {email_id}: {validation_error[0]}")
+                    continue
+
+                # Same Draft -> Queued claim as the single send
+                queued = EntryField.objects.filter(
+                    entry_id=email_id, key="status", value="Draft"
+                ).update(value="Queued")
+                if not queued:
+                    errors.append(f"Email {email_id}: already queued for sending.")
+                    continue
+                queued_ids.append(email_id)
+
+            if queued_ids:
+                Entry.objects.filter(pk__in=queued_ids).update(modified_at=timezone.now())
+
+                # Only the batch task is dispatched, so these emails share one
+                # mail connection and no per-email task competes for them
+                transaction.on_commit(
+                    partial(
+                        _dispatch_queued,
+                        queued_ids,
+                        send_correspondence_emails_task,
+                        queued_ids,
+                        request.user.id,
+                    )
+                )
+
+        if not queued_ids:
+            return _error_response(
+                request, is_json, "; ".join(errors), purge_record_id, level=messages.WARNING
+            )
+
+        # Success response
+        success_msg = f"{len(queued_ids)} email(s) have been queued for sending."
 
         # Return JSON for AJAX requests
-        if request.headers.get("Content-Type") == "application/json":
-            return JsonResponse({"success": False, "error": error_msg})
+        if is_json:
+            return CompactJsonResponse(
+                {
+                    "success": True,
+                    "message": success_msg,
+                    "status": "Queued",
+                    "queued": queued_ids,
+                    "errors": errors,
+                }
+            )
+        messages.success(request, success_msg)
+        if errors:
+            messages.warning(request, "; ".join(errors))
 
-        # Fallback to original redirect behavior
-        messages.error(request, error_msg)
+        return _redirect_back(purge_record_id)
 
-    return redirect("bluebird:view_internal_purge_records")
\ No newline at end of file
+    except Exception as e:
+        error_msg = f"Error sending emails: {str(e)}"
+        logger.error(f"Unexpected error in send_correspondence_emails: {str(e)}", exc_info=True)
+        return _error_response(request, is_json, error_msg, purge_record_id)
@@ -0,0 +1,482 @@
+import io
+import os
+import re
+import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from celery import shared_task
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+from django.db import transaction
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template import TemplateDoesNotExist, TemplateSyntaxError
+from django.template.loader import get_template
+from django.conf import settings
+import mimetypes
+
+from apps.bluebird.models import Entry, EntryField, DocumentMetadata
+
+logger = logging.getLogger(__name__)
+
+# Low-level clients are thread-safe, so one per worker process is shared by
+# every send instead of being rebuilt for each attachment. The connection pool
+# is sized above the download pool so parallel GETs don't discard connections,
+# and adaptive retries back off on S3 throttling.
+_MAX_DOWNLOAD_WORKERS = 16
+_S3_CLIENT = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=32,
+        retries={"max_attempts": 5, "mode": "adaptive"},
+        tcp_keepalive=True,
+        connect_timeout=5,
+        read_timeout=60,
+    ),
+)
+_BUCKET_NAME = os.environ.get("BLUEBIRD_FILES_BUCKET")
+
+# Objects above 16 MB are re-fetched as 16 MB ranged GETs; attachments already
+# download in parallel, so only a couple of ranges run per object
+_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=_MULTIPART_THRESHOLD,
+    multipart_chunksize=_MULTIPART_THRESHOLD,
+    max_concurrency=2,
+)
+
+# Load the system MIME database at import instead of on the first attachment,
+# and resolve the extensions this site sees most without touching it at all
+mimetypes.init()
+_EXT_TO_MIME = {
+    ".pdf": "application/pdf",
+    ".doc": "application/msword",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xls": "application/vnd.ms-excel",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    ".csv": "text/csv",
+    ".txt": "text/plain",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+    ".zip": "application/zip",
+}
+
+
+# Tags are removed in one linear pass; the result is only used as the
+# plain-text alternative, never rendered as HTML
+_TAG_RE = re.compile(r"<[^>]+>")
+
+# Used when the correspondence template can't be loaded
+_FALLBACK_HTML = """
+<html>
+    <body>
+        <div style="font-family: Arial, sans-serif; padding: 20px;">
+            <h2>{subject}</h2>
+            <div style="white-space: pre-wrap;">{body_content}</div>
+            <hr style="margin: 20px 0;">
+            <p style="color: #666; font-size: 12px;">
+                This email was sent via the Purge Workflow System<br>
+                Email Type: {email_type}<br>
+                Priority: {priority}<br>
+                Sent by: {sender_name}
+            </p>
+        </div>
+    </body>
+</html>
+"""
+
+
+@lru_cache(maxsize=None)
+def _get_correspondence_template():
+    """
+    Load and compile the correspondence email template once per process.
+
+    Returns None if the template is missing or fails to parse; that result is
+    cached too, so the fallback path doesn't hit the loaders on every send.
+    """
+    try:
+        return get_template("emails/correspondence_email.html")
+    except (TemplateDoesNotExist, TemplateSyntaxError) as template_error:
+        logger.warning(f"Email template unavailable, using plain text: {template_error}")
+        return None
+
+
+def _fallback_html(subject, body_content, email_fields, sender_name):
+    """
+    Build the inline HTML body used when the template is unavailable.
+    """
+    return _FALLBACK_HTML.format_map({
+        "subject": subject,
+        "body_content": body_content,
+        "email_type": email_fields.get("email_type", "N/A"),
+        "priority": email_fields.get("priority", "Normal"),
+        "sender_name": sender_name,
+    })
+
+
+def _strip_tags(value):
+    """
+    Return ``value`` with HTML tags removed.
+    """
+    return _TAG_RE.sub("", value)
+
+
+def _guess_mime_type(filename):
+    """
+    Return the MIME type for an attachment filename.
+    """
+    mime_type = _EXT_TO_MIME.get(os.path.splitext(filename)[1].lower())
+    if not mime_type:
+        mime_type, _ = mimetypes.guess_type(filename)
+    return mime_type or 'application/octet-stream'
+
+
+def _split_csv(value):
+    """
+    Split a comma-separated address list, dropping blank entries.
+    """
+    if not value:
+        return []
+    return [item for item in map(str.strip, value.split(",")) if item]
+
+
+def _download_attachment(attachment):
+    """
+    Download a single attachment from S3.
+
+    Returns ``(filename, file_content, mime_type)``; errors propagate to the
+    caller through the executor future.
+    """
+    # Get file from S3; a single GET covers the common small attachment
+    s3_response = _S3_CLIENT.get_object(
+        Bucket=_BUCKET_NAME,
+        Key=attachment.s3_key
+    )
+    if s3_response["ContentLength"] <= _MULTIPART_THRESHOLD:
+        file_content = s3_response["Body"].read()
+    else:
+        # Large objects are worth the managed transfer's ranged GETs
+        s3_response["Body"].close()
+        buffer = io.BytesIO()
+        _S3_CLIENT.download_fileobj(
+            _BUCKET_NAME,
+            attachment.s3_key,
+            buffer,
+            Config=_TRANSFER_CONFIG,
+        )
+        file_content = buffer.getvalue()
+
+    # Determine MIME type
+    mime_type = _guess_mime_type(attachment.filename)
+
+    return attachment.filename, file_content, mime_type
+
+
+def release_queued_emails(email_ids):
+    """
+    Put emails that are still 'Queued' back into 'Draft', e.g. when their task
+    couldn't be dispatched or can't run, so they don't stay stuck in the queue.
+    """
+    with transaction.atomic(savepoint=False):
+        EntryField.objects.filter(
+            entry_id__in=email_ids, key="status", value="Queued"
+        ).update(value="Draft")
+        Entry.objects.filter(pk__in=email_ids).update(modified_at=timezone.now())
+
+
+def _get_sender(email_ids, user_id):
+    """
+    Return the user who queued ``email_ids``, or None after releasing the
+    emails back to Draft if that user no longer exists.
+    """
+    try:
+        return get_user_model().objects.get(pk=user_id)
+    except get_user_model().DoesNotExist:
+        logger.error(f"User {user_id} not found; returning emails {email_ids} to Draft.")
+        release_queued_emails(email_ids)
+        return None
+
+
+def _reset_to_draft(email_entry):
+    """
+    Put a claimed email back into 'Draft' so it can be edited and sent again.
+    """
+    with transaction.atomic(savepoint=False):
+        EntryField.objects.filter(entry=email_entry, key="status").update(value="Draft")
+        Entry.objects.filter(pk=email_entry.pk).update(modified_at=timezone.now())
+
+
+def _send_correspondence_email(email_id, user, connection=None):
+    """
+    Send a queued email correspondence and update its status to 'Sent'.
+
+    ``connection`` is an open mail backend to send through; when None the
+    message opens and closes its own.
+    """
+    try:
+        email_entry = Entry.objects.only("id").get(
+            id=email_id, section__key="purge/internal/email"
+        )
+    except Entry.DoesNotExist:
+        error_msg = f"Email correspondence with ID {email_id} not found."
+        logger.error(error_msg)
+        return {"success": False, "error": error_msg}
+
+    # Claim the email by moving it from Queued to Sending; if another task got
+    # there first, or it was sent or reset in the meantime, leave it alone
+    claimed = EntryField.objects.filter(
+        entry=email_entry, key="status", value="Queued"
+    ).update(value="Sending")
+    if not claimed:
+        error_msg = f"Email {email_id} was not sent. Only Queued emails can be sent."
+        logger.warning(error_msg)
+        return {"success": False, "error": error_msg}
+
+    sender_display = user.get_full_name() or user.username
+    sender_username = user.username
+
+    # === ACTUAL EMAIL SENDING LOGIC ===
+    try:
+        # Get the email details from entry fields; loaded once after the claim
+        # and reused for the status update after the send
+        entry_fields = list(email_entry.fields.all())
+        email_fields = {field.key: field.value for field in entry_fields}
+
+        recipient_email = email_fields.get("recipient_email", "")
+        subject = email_fields.get("subject", "")
+        body_content = email_fields.get("body_content", "")
+        sender_email = email_fields.get("sender_email", settings.DEFAULT_FROM_EMAIL)
+
+        # Get CC and BCC if they exist
+        cc_emails = email_fields.get("cc_emails", "")
+        bcc_emails = email_fields.get("bcc_emails", "")
+
+        # Parse CC and BCC (assume comma-separated)
+        cc_list = _split_csv(cc_emails)
+        bcc_list = _split_csv(bcc_emails)
+
+        # Get purge record information for context
+        purge_record_id = email_fields.get("purge_record_id")
+        purge_info = {}
+        if purge_record_id:
+            try:
+                purge_record = Entry.objects.only("id").get(
+                    id=purge_record_id,
+                    section__key__in=["purge/internal", "purge/ic"]
+                )
+                purge_fields = dict(purge_record.fields.values_list("key", "value"))
+                purge_info = {
+                    "id": purge_record_id,
+                    "account": purge_fields.get("account", "N/A"),
+                    "provider": purge_fields.get("provider", "N/A"),
+                    "facility": purge_fields.get("facility", "N/A"),
+                    "status": purge_fields.get("status", "N/A"),
+                }
+            except Entry.DoesNotExist:
+                pass
+
+        # Prepare email context for template
+        email_context = {
+            "subject": subject,
+            "body_content": body_content,
+            "email_type": email_fields.get("email_type", ""),
+            "priority": email_fields.get("priority", "Normal"),
+            "purge_info": purge_info,
+            "sender_name": sender_display,
+            "email_date": email_fields.get("email_date", timezone.now().strftime("%Y-%m-%d")),
+        }
+
+        # Create HTML email from template (if template exists)
+        template = _get_correspondence_template()
+        html_content = None
+        if template is not None:
+            try:
+                html_content = template.render(email_context)
+                # Create plain text version by stripping HTML
+                text_content = _strip_tags(body_content)
+            except Exception as template_error:
+                logger.warning(f"Email template failed to render, using plain text: {template_error}")
+        if html_content is None:
+            # Fallback to plain text if the template is unavailable
+            html_content = _fallback_html(
+                subject, body_content, email_fields, sender_display
+            )
+            text_content = body_content
+
+        # Create the email message
+        email_message = EmailMultiAlternatives(
+            subject=subject,
+            body=text_content,
+            from_email=sender_email,
+            to=[recipient_email],
+            cc=cc_list if cc_list else None,
+            bcc=bcc_list if bcc_list else None,
+            reply_to=[sender_email] if sender_email != settings.DEFAULT_FROM_EMAIL else None,
+            connection=connection,
+        )
+
+        # Attach HTML version
+        email_message.attach_alternative(html_content, "text/html")
+
+        # Attach files from DocumentMetadata; materialized so the download
+        # threads never touch the queryset
+        attachments = list(
+            DocumentMetadata.objects.filter(
+                entry=email_entry,
+                is_deleted=False
+            ).only("filename", "s3_key")
+        )
+
+        # Download attachments concurrently; the work is network-bound
+        futures = []
+        if attachments:
+            max_workers = min(_MAX_DOWNLOAD_WORKERS, len(attachments))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    executor.submit(_download_attachment, attachment)
+                    for attachment in attachments
+                ]
+
+        attachment_errors = []
+        for attachment, future in zip(attachments, futures):
+            download_error = future.exception()
+            if download_error is None:
+                # Attach to email
+                email_message.attach(*future.result())
+                continue
+
+            if isinstance(download_error, ClientError):
+                error_detail = f"S3 error for {attachment.filename}: {str(download_error)}"
+            else:
+                error_detail = f"Failed to attach {attachment.filename}: {str(download_error)}"
+            logger.error(error_detail)
+            attachment_errors.append(error_detail)
+
+        # Send the email; sent_date and modified_at both use this timestamp
+        email_message.send(fail_silently=False)
+        now = timezone.now()
+
+    except Exception as send_error:
+        # Put the email back into Draft so the user can retry
+        error_msg = f"Failed to send email: {str(send_error)}"
+        logger.error(error_msg, exc_info=True)
+        _reset_to_draft(email_entry)
+        return {"success": False, "error": error_msg}
+
+    # Add warning if there were attachment errors
+    warning_msg = ""
+    if attachment_errors:
+        warning_msg = f"Email sent, but some attachments failed: {'; '.join(attachment_errors[:3])}"
+        if len(attachment_errors) > 3:
+            warning_msg += f" and {len(attachment_errors) - 3} more..."
+        logger.warning(warning_msg)
+
+    # === UPDATE DATABASE AFTER SUCCESSFUL SEND ===
+    # Update status, sent_date and sent_by using bulk operations
+    sent_date_value = now.isoformat()
+    sent_values = {
+        "status": "Sent",
+        "sent_date": sent_date_value,
+        "sent_by": sender_username,
+    }
+
+    # The send runs in the background, so attachment failures are stored on
+    # the entry where the correspondence views can show them; a warning left
+    # by an earlier send is cleared
+    if warning_msg or any(field.key == "send_warning" for field in entry_fields):
+        sent_values["send_warning"] = warning_msg
+
+    try:
+        existing_fields = {
+            field.key: field for field in entry_fields if field.key in sent_values
+        }
+        fields_to_update_bulk = []
+        fields_to_create = []
+        for key, value in sent_values.items():
+            if key in existing_fields:
+                existing_fields[key].value = value
+                fields_to_update_bulk.append(existing_fields[key])
+            else:
+                fields_to_create.append(EntryField(entry=email_entry, key=key, value=value))
+
+        # Perform all database operations atomically
+        with transaction.atomic(savepoint=False):
+            # Bulk create new fields
+            if fields_to_create:
+                EntryField.objects.bulk_create(fields_to_create)
+
+            # Bulk update existing fields
+            if fields_to_update_bulk:
+                EntryField.objects.bulk_update(fields_to_update_bulk, ["value"])
+
+            # Update entry modified timestamp with specific field update
+            Entry.objects.filter(pk=email_entry.pk).update(modified_at=now)
+
+    except Exception as db_error:
+        # The email has already been delivered, so it stays in Sending rather
+        # than going back to Draft where it could be sent a second time
+        error_msg = f"Email {email_id} was sent, but its status could not be updated: {str(db_error)}"
+        logger.error(error_msg, exc_info=True)
+        return {"success": False, "error": error_msg, "status": "Sending"}
+
+    result = {
+        "success": True,
+        "message": f"Email '{subject}' has been sent successfully to {recipient_email}.",
+        "status": "Sent",
+        "sent_date": sent_date_value,
+    }
+
+    if warning_msg:
+        result["warning"] = warning_msg
+
+    return result
+
+
+@shared_task
+def send_correspondence_email_task(email_id, user_id):
+    """
+    Send a single queued email correspondence.
+    """
+    user = _get_sender([email_id], user_id)
+    if user is None:
+        return {"success": False, "error": f"User {user_id} not found."}
+    return _send_correspondence_email(email_id, user)
+
+
+@shared_task(acks_late=True, reject_on_worker_lost=True)
+def send_correspondence_emails_task(email_ids, user_id):
+    """
+    Send a batch of queued email correspondences over one mail connection,
+    so the SMTP/TLS handshake is paid once for the whole batch. Dispatched by
+    the send_correspondence_emails view; each email is still claimed
+    individually before it is sent, so a redelivered batch only sends the
+    emails that are still Queued.
+    """
+    user = _get_sender(email_ids, user_id)
+    if user is None:
+        return [{"success": False, "error": f"User {user_id} not found."}] * len(email_ids)
+
+    connection = get_connection()
+    try:
+        connection.open()
+    except Exception as connection_error:
+        error_msg = f"Failed to open mail connection: {str(connection_error)}"
+        logger.error(error_msg, exc_info=True)
+        release_queued_emails(email_ids)
+        return [{"success": False, "error": error_msg}] * len(email_ids)
+
+    try:
+        return [
+            _send_correspondence_email(email_id, user, connection=connection)
+            for email_id in email_ids
+        ]
+    finally:
+        connection.close()
+        # If the loop was cut short, emails it never claimed go back to Draft
+        release_queued_emails(email_ids)